@@ -1,12 +1,19 @@
+import io
 import os
 import re
 import sys
 import xml.etree.ElementTree as ET
+from collections.abc import Iterable, Iterator
+from functools import cache
+from http import HTTPStatus
+from typing import TYPE_CHECKING
 
-import requests
 from git import Commit, Repo, TagReference
 
-GIT_MESSAGE_PREFIX = [
+if TYPE_CHECKING:
+    import requests
+
+GIT_MESSAGE_PREFIX = (
     "build",
     "chore",
     "ci",
@@ -18,53 +25,102 @@ GIT_MESSAGE_PREFIX = [
     "refactor",
     "style",
     "test",
-]
+)
+NON_WORD_RE = re.compile(r"[^\w\s]")
+
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+GITHUB_REPOSITORY = os.environ.get("GITHUB_REPOSITORY")
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+GITHUB_OUTPUT = os.environ.get("GITHUB_OUTPUT")
+GITHUB_RELEASES_ENDPOINT = f"{GITHUB_API_URL}/repos/{GITHUB_REPOSITORY}/releases"
+
+
+@cache
+def get_github_session() -> "requests.Session":
+    # requests is only needed when a release is created, so import it on first use
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.headers.update({
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": "2022-11-28"
+    })
+    if GITHUB_TOKEN:
+        session.headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+    # POST is not retried on error responses, so only connection failures are retried
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=3))
+    return session
 
 
 def get_last_tag(repo: Repo, branch_name: str) -> TagReference:
     # Get the last tag in the given branch
-    tags = [repo.tag(tag) for tag in repo.git.tag("--merged", branch_name).split("\n")]
-    last_tag = max(tags, key=lambda tag: tag.commit.committed_date) if tags else None
-    return last_tag
+    # annotated tags only expose the commit date on the dereferenced object (*committerdate),
+    # lightweight tags only on the ref itself, so exactly one of the two fields is set
+    output = repo.git.for_each_ref(
+        "--merged", branch_name,
+        "--format=%(*committerdate:unix)%(committerdate:unix) %(refname:short)",
+        "refs/tags"
+    )
+    if not output:
+        return None
+    tags = [line.split(" ", 1) for line in output.split("\n")]
+    _, last_tag_name = max(tags, key=lambda tag: int(tag[0]))
+    return repo.tag(last_tag_name)
+
+
+def get_commit_summaries(repo: Repo, start_commit: Commit, end_commit: Commit) -> Iterator[str]:
+    # Let git format the summaries instead of building a Commit object per revision,
+    # and stream them so git is stopped as soon as the caller has seen enough
+    rev = f"{start_commit}..{end_commit}" if start_commit else str(end_commit)
+    proc = repo.git.log(rev, "--format=%s", as_process=True)
+    for line in proc.stdout:
+        yield line.decode(errors="replace").rstrip("\n")
+    proc.wait()
+
+
+def log_commits(summaries: Iterable[str]) -> Iterator[str]:
+    # Print commits as they are consumed, so short-circuiting callers only read what they need
+    print("Commits:")
+    for summary in summaries:
+        print(f" - {summary}")
+        yield summary
 
 
-def get_commits_between(repo: Repo, start_commit: Commit, end_commit: Commit) -> list[Commit]:
-    commits = list(repo.iter_commits(rev=f"{start_commit}..{end_commit}"))
-    print("Commits:")
-    for commit in commits:
-        print(f" - {commit.summary}")
-    return commits
+def is_new_release(summaries: Iterable[str] = ()):
+    return any(summary.startswith(GIT_MESSAGE_PREFIX) for summary in summaries)
 
 
-def is_new_release(commits: list[Commit] = []):
-    for commit in commits:
-        if commit.summary.startswith(tuple(GIT_MESSAGE_PREFIX)):
-            return True
-    return False
+def get_pom_version(pom_stream) -> str:
+    # Stop at the project's own <version>; don't build <dependencies>, <build>, etc.
+    ns = "{http://maven.apache.org/POM/4.0.0}"
+    depth = 0
+    for event, elem in ET.iterparse(pom_stream, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag == f"{ns}version":
+            return elem.text
+        elem.clear()
+    raise ValueError("pom.xml has no project version")
 
 
-def add_github_output(name, value):
-    with open(os.environ["GITHUB_OUTPUT"], "a") as f:
-        f.write(f"{name}={value}\n")
+def write_github_outputs(outputs: dict[str, str]):
+    with open(GITHUB_OUTPUT, "a") as f:
+        f.writelines(f"{name}={value}\n" for name, value in outputs.items())
 
 
 def create_gh_release(tag_name: str):
-    github_token = os.environ["GITHUB_TOKEN"]
-    github_repository = os.environ["GITHUB_REPOSITORY"]
-    github_api_endpoint = f"https://api.github.com/repos/{github_repository}/releases"
-    headers = {
-        "Authorization": f"Bearer {github_token}",
-        "Accept": "application/vnd.github+json",
-        "X-GitHub-Api-Version": "2022-11-28"
-    }
+    is_prerelease = "-" in tag_name
     data = {
         "tag_name": tag_name,
         "name": tag_name,
-        "prerelease": True if len(tag_name.split("-")) > 1 else False,
-        "make_latest": "false" if len(tag_name.split("-")) > 1 else "true"
+        "prerelease": is_prerelease,
+        "make_latest": "false" if is_prerelease else "true"
     }
-    with requests.post(github_api_endpoint, json=data, headers=headers) as r:
-        if r.status_code == requests.codes.created:
+    with get_github_session().post(GITHUB_RELEASES_ENDPOINT, json=data, timeout=10) as r:
+        if r.status_code == HTTPStatus.CREATED:
             print("Release created")
         else:
             print(r.status_code)
@@ -74,40 +130,45 @@ def create_gh_release(tag_name: str):
 def main():
     repo = Repo(os.environ["GITHUB_WORKSPACE"])
 
-    current_branch = repo.active_branch.name
+    active_branch = repo.active_branch
+    current_branch = active_branch.name
+    head_commit = active_branch.commit
     last_tag = get_last_tag(repo, current_branch)
     last_tag_commit = last_tag.commit if last_tag else None
-    print(f"current tag: {last_tag.name}")
+    print(f"current tag: {last_tag.name if last_tag else None}")
 
     # check if empty
-    commits = get_commits_between(repo, last_tag_commit, repo.active_branch.commit)
-    create_new_release = is_new_release(commits)
+    summaries = get_commit_summaries(repo, last_tag_commit, head_commit)
+    create_new_release = is_new_release(log_commits(summaries))
+    # stop git log now rather than leaving it blocked until main() returns
+    summaries.close()
+    outputs = {}
 
     if create_new_release:
-        blob = repo.head.commit.tree["pom.xml"]
-        ns = "{http://maven.apache.org/POM/4.0.0}"
-        pom = ET.fromstring(blob.data_stream.read().decode())
-
-        pom_version = pom.find(f"{ns}version").text
+        blob = head_commit.tree["pom.xml"]
+        # read the whole blob so the shared cat-file stream is never left half consumed
+        pom_version = get_pom_version(io.BytesIO(blob.data_stream.read()))
 
         if current_branch in ["master"]:
             version_string = pom_version
         else:
-            pre_release = re.sub(r"[^\w\s]", ".", current_branch).lower()
-            last_tag_build = last_tag.name.removeprefix(f"v{pom_version}-{pre_release}.")
-            if last_tag_build.isnumeric():
-                build = int(last_tag_build) + 1
-            else:
-                build = 1
+            pre_release = NON_WORD_RE.sub(".", current_branch).lower()
+            build_re = re.compile(fr"v{re.escape(pom_version)}-{re.escape(pre_release)}\.(\d+)")
+            last_tag_build = build_re.fullmatch(last_tag.name) if last_tag else None
+            build = int(last_tag_build.group(1)) + 1 if last_tag_build else 1
             version_string = f"v{pom_version}-{pre_release}.{build}"
 
         print(f"new tag: {version_string}")
+        if not GITHUB_TOKEN or not GITHUB_REPOSITORY:
+            print("GITHUB_TOKEN and GITHUB_REPOSITORY are required to create a release", file=sys.stderr)
+            return 1
         new_tag = repo.create_tag(version_string)
         repo.remotes.origin.push(new_tag)
         create_gh_release(version_string)
-        add_github_output("new_release_version", version_string)
+        outputs["new_release_version"] = version_string
 
-    add_github_output("new_release", "true" if create_new_release else "false")
+    outputs["new_release"] = "true" if create_new_release else "false"
+    write_github_outputs(outputs)
 
 
 if __name__ == '__main__':